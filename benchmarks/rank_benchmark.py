@@ -0,0 +1,127 @@
+"""Benchmark note_search against the ranking it replaced.
+
+Builds a database of generated notes and times, for each query, the original ranking
+loop (fuzz.WRatio on every note, then heapq.nlargest) against rank.Ranker, and the
+original note_search (every note loaded with its tags and notebook) against
+db.note_search. Results of both are checked to be identical.
+
+The original note_search looks up the tags of every note one query at a time, so it
+takes close to an hour per query at 100k notes. Pass --skip-search to time only the
+ranking at that size.
+
+    python benchmarks/rank_benchmark.py --notes 10000
+    python benchmarks/rank_benchmark.py --notes 100000 --skip-search
+"""
+import os
+import time
+import heapq
+import random
+import argparse
+import tempfile
+
+import dataset
+from fuzzywuzzy import fuzz
+
+from clearfile import db, rank
+
+SCHEMA = os.path.join(os.path.dirname(db.__file__), 'clearfile.sql')
+QUERIES = ['calculus', 'matrix determinant', 'lecture notes', 'qqzx']
+
+
+def baseline_rank(query, candidates, k=10):
+    """Ranking loop of the original note_search."""
+    scored = []
+    for i, (title, text) in enumerate(candidates):
+        score = max(fuzz.WRatio(query, text), fuzz.WRatio(query, title))
+        if score > rank.SCORE_CUTOFF:
+            scored.append((score, i))
+    return heapq.nlargest(k, scored, key=lambda r: r[0])
+
+
+def baseline_note_search(conn, search):
+    """The original note_search, without notebook or location filters."""
+    notes = db.get_notes(conn)
+    scored = []
+    for n in notes:
+        score = max(fuzz.WRatio(search, n.ocr_text), fuzz.WRatio(search, n.name))
+        if search == '' or score > 50:
+            scored.append((score, n))
+    return [nt for _, nt in heapq.nlargest(10, scored, key=lambda r: r[0])]
+
+
+def generate(db_file, n, seed):
+    """Fill db_file with n notes of OCR-like text, each with 5 tags."""
+    rng = random.Random(seed)
+    words = [
+        'calculus', 'algebra', 'matrix', 'vector', 'integral', 'derivative', 'physics',
+        'energy', 'chemistry', 'reaction', 'history', 'essay', 'biology', 'lecture',
+        'notes', 'exam', 'determinant', 'limit', 'series', 'theorem'
+    ]
+    words += [
+        ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 9)))
+        for _ in range(5000)
+    ]
+    db.create_db_if_not_exists(SCHEMA, db_file)
+    conn = dataset.connect(f'sqlite:///{db_file}')
+    with conn:
+        conn['notebooks'].insert_many([{'name': 'maths'}, {'name': 'science'}])
+        conn['notes'].insert_many([{
+            'uuid': f'note-{i}',
+            'name': ' '.join(rng.choices(words, k=rng.randint(1, 4))),
+            'ocr_text': ' '.join(rng.choices(words, k=rng.choice([20, 100, 300, 600]))),
+            'mime': 'image/jpeg',
+            'notebook': rng.choice([None, 1, 2])
+        } for i in range(n)])
+        conn['tags'].insert_many([{
+            'uuid': f'note-{i}',
+            'tag': rng.choice(words)
+        } for i in range(n) for _ in range(5)])
+    return conn
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notes', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--query', action='append', dest='queries')
+    parser.add_argument('--skip-search', action='store_true',
+                        help='only compare the ranking, not the whole note_search')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = generate(os.path.join(directory, 'clearfile.db'), args.notes, args.seed)
+        candidates = [(note['name'], note['ocr_text']) for note in conn['notes'].all()]
+        totals = [0.0] * 4
+        print(f'{args.notes} notes')
+        print(f'{"query":<20} {"old rank":>9} {"new rank":>9} {"old search":>11} '
+              f'{"new search":>11}')
+        for query in args.queries or QUERIES:
+            old, old_rank = timed(baseline_rank, query, candidates)
+            new, new_rank = timed(rank.Ranker(query).rank, candidates)
+            assert old == new, (query, old, new)
+            old_search = new_search = 0.0
+            if not args.skip_search:
+                old, old_search = timed(baseline_note_search, conn, query)
+                new, new_search = timed(db.note_search, conn, query)
+                assert [n.uuid for n in old] == [n.uuid for n in new], query
+            times = [old_rank, new_rank, old_search, new_search]
+            totals = [total + t for total, t in zip(totals, times)]
+            print(f'{query:<20} {old_rank:>8.2f}s {new_rank:>8.2f}s {old_search:>10.2f}s '
+                  f'{new_search:>10.2f}s', flush=True)
+        print(f'{"total":<20} {totals[0]:>8.2f}s {totals[1]:>8.2f}s {totals[2]:>10.2f}s '
+              f'{totals[3]:>10.2f}s')
+        print(f'speedup: ranking {totals[0] / totals[1]:.1f}x', end='')
+        if args.skip_search:
+            print()
+        else:
+            print(f', note_search {totals[2] / totals[3]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
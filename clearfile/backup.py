@@ -0,0 +1,327 @@
+"""Streaming backup and restore of a clearfile directory.
+
+Archives are uncompressed tar streams, written and read sequentially so they can be
+piped straight to (or from) another program without being staged on disk. Every
+archive starts with a manifest.json member describing it:
+
+    full backups hold a SQL dump of the database, split into numbered members of at
+    most DUMP_CHUNK_SIZE bytes (clearfile.sql.000, clearfile.sql.001, ...), followed
+    by every note's original and thumbnail under files/.
+
+    incremental backups hold only the rows of notes changed since a checkpoint
+    (notes.json), the uuids of notes deleted since then, and the files of the
+    changed notes.
+
+The database is read inside a single read transaction, so exports are consistent while
+the server is writing without copying the database first. The checkpoint is the id of
+the latest row in the changes table, which is filled by triggers whenever a note or its
+tags change (see clearfile.sql).
+"""
+import io
+import os
+import glob
+import json
+import shutil
+import sqlite3
+import tarfile
+import mimetypes
+
+MANIFEST = 'manifest.json'
+DUMP = 'clearfile.sql'
+NOTES = 'notes.json'
+FILES_DIR = 'files'
+THUMB_DIR = 'thumb'
+# Bytes of a database dump buffered in memory before it is written as an archive member.
+DUMP_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def note_files(uuid, mime):
+    """Return the paths (relative to the clearfile directory) of a note's files."""
+    files = [uuid + mimetypes.guess_extension(mime)]
+    # Image files are used as their own thumbnail, see Note.has_thumbnail.
+    if not mime.startswith('image/'):
+        files.append(os.path.join(THUMB_DIR, f'{uuid}.jpe'))
+    return files
+
+
+def read_transaction(db_file):
+    """Return a connection to the database with a read transaction open on it.
+
+    Every query on the connection sees the same consistent state of the database, even
+    while the server is writing to it, until the connection is closed.
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('BEGIN')
+    return conn
+
+
+def checkpoint_of(conn):
+    """Return the id of the latest change recorded in the database."""
+    return conn.execute('SELECT COALESCE(MAX(`id`), 0) FROM `changes`').fetchone()[0]
+
+
+def changed_since(conn, since):
+    """Return the uuids of notes changed after the checkpoint since."""
+    rows = conn.execute(
+        'SELECT DISTINCT `uuid` FROM `changes` WHERE `id` > ?', (since, ))
+    return {row[0] for row in rows}
+
+
+def _add_bytes(archive, name, data):
+    """Add an in-memory member to a tar archive."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    archive.addfile(info, io.BytesIO(data))
+
+
+def _add_json(archive, name, obj):
+    """Add an object to a tar archive as a JSON member."""
+    _add_bytes(archive, name, json.dumps(obj).encode('utf-8'))
+
+
+def _add_note_files(archive, clearfile_dir, notes):
+    """Stream the files of each note into the archive, skipping ones that have gone missing."""
+    for note in notes:
+        for rel in note_files(note['uuid'], note['mime']):
+            try:
+                f = open(os.path.join(clearfile_dir, rel), 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                info = archive.gettarinfo(
+                    arcname=f'{FILES_DIR}/{rel}', fileobj=f)
+                archive.addfile(info, f)
+
+
+def _add_dump(archive, conn):
+    """Write a SQL dump of the database to the archive as numbered members.
+
+    Statements are buffered until DUMP_CHUNK_SIZE bytes are held, then written out as
+    the next member, so chunks may end part way through a statement.
+    """
+    chunk = bytearray()
+    index = 0
+    for statement in conn.iterdump():
+        chunk += statement.encode('utf-8') + b'\n'
+        while len(chunk) >= DUMP_CHUNK_SIZE:
+            _add_bytes(archive, f'{DUMP}.{index:03d}', bytes(chunk[:DUMP_CHUNK_SIZE]))
+            del chunk[:DUMP_CHUNK_SIZE]
+            index += 1
+    if chunk:
+        _add_bytes(archive, f'{DUMP}.{index:03d}', bytes(chunk))
+
+
+def _changes_since(conn, since, deleted):
+    """Return the rows of notes changed after the checkpoint since.
+
+    The uuids of changed notes that no longer exist are appended to deleted.
+    """
+    notes, tags = [], []
+    for uuid in sorted(changed_since(conn, since)):
+        row = conn.execute('SELECT * FROM `notes` WHERE `uuid` = ?',
+                           (uuid, )).fetchone()
+        if row is None:
+            deleted.append(uuid)
+            continue
+        notes.append(dict(row))
+        tags.extend(
+            dict(tag)
+            for tag in conn.execute('SELECT * FROM `tags` WHERE `uuid` = ?', (uuid, )))
+    notebooks = [dict(row) for row in conn.execute('SELECT * FROM `notebooks`')]
+    return {'notes': notes, 'tags': tags, 'notebooks': notebooks}
+
+
+def export_archive(clearfile_dir, db_file, out, since=None):
+    """Write a backup archive of a clearfile directory to the binary stream out.
+
+    If since is a checkpoint from a previous export, only notes changed after it are
+    written. Returns the checkpoint of this export.
+    """
+    with tarfile.open(fileobj=out, mode='w|') as archive:
+        conn = read_transaction(db_file)
+        try:
+            checkpoint = checkpoint_of(conn)
+            manifest = {'checkpoint': checkpoint, 'since': since, 'deleted': []}
+            if since is None:
+                notes = [
+                    dict(row)
+                    for row in conn.execute('SELECT `uuid`, `mime` FROM `notes`')
+                ]
+                _add_json(archive, MANIFEST, manifest)
+                _add_dump(archive, conn)
+            else:
+                changes = _changes_since(conn, since, manifest['deleted'])
+                notes = changes['notes']
+                _add_json(archive, MANIFEST, manifest)
+                _add_json(archive, NOTES, changes)
+        finally:
+            conn.close()
+        _add_note_files(archive, clearfile_dir, notes)
+    return checkpoint
+
+
+def compact_changes(db_file):
+    """Collapse the changes table to the latest change of each note.
+
+    Incremental exports only ask which notes changed after a checkpoint, which the latest
+    change of each note still answers.
+    """
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute('DELETE FROM `changes` WHERE `id` NOT IN '
+                     '(SELECT MAX(`id`) FROM `changes` GROUP BY `uuid`)')
+    conn.close()
+
+
+def _ensure_columns(conn, table, columns):
+    """Add any columns missing from table (dataset adds columns to notes lazily)."""
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info(`{table}`)')}
+    for column in columns:
+        if column not in existing:
+            conn.execute(f'ALTER TABLE `{table}` ADD COLUMN `{column}`')
+
+
+def _replace_rows(conn, table, rows):
+    """Insert rows into table, replacing any with the same primary key."""
+    _ensure_columns(conn, table, {column for row in rows for column in row})
+    for row in rows:
+        columns = ', '.join(f'`{column}`' for column in row)
+        params = ', '.join('?' for _ in row)
+        conn.execute(
+            f'INSERT OR REPLACE INTO `{table}` ({columns}) VALUES ({params})',
+            list(row.values()))
+
+
+class _DumpRestore(object):
+    """Replays the chunks of a SQL dump over the database in a single transaction.
+
+    The tables of the database are dropped and recreated from the dump, so readers see
+    either the old contents or the restored ones. Nothing is written unless the dump
+    is replayed to its end.
+    """
+
+    def __init__(self, db_file):
+        """Open the database and drop its tables, inside a transaction."""
+        self.conn = sqlite3.connect(db_file, isolation_level=None)
+        self.conn.execute('BEGIN')
+        tables = self.conn.execute("SELECT `name` FROM `sqlite_master` WHERE "
+                                   "`type` = 'table' AND `name` NOT LIKE 'sqlite_%'")
+        for (table, ) in tables.fetchall():
+            self.conn.execute(f'DROP TABLE `{table}`')
+        self.chunks = 0
+        self.statement = bytearray()
+        self.done = False
+
+    def replay(self, index, chunk):
+        """Execute the statements of the numbered chunk read from a binary stream."""
+        if index != self.chunks or self.done:
+            raise ValueError('Backup archive has database chunks out of order.')
+        self.chunks += 1
+        for line in iter(chunk.readline, b''):
+            self.statement += line
+            # Dumped statements end a line, checking only then avoids rescanning
+            # long multi-line text values.
+            if not self.statement.endswith(b';\n'):
+                continue
+            statement = self.statement.decode('utf-8')
+            if not sqlite3.complete_statement(statement):
+                continue
+            self.statement.clear()
+            if statement == 'BEGIN TRANSACTION;\n':
+                continue
+            self.conn.execute(statement)
+            if statement == 'COMMIT;\n':
+                self.done = True
+
+    def close(self):
+        """Roll back the restore unless the whole dump was replayed."""
+        if not self.done and self.conn.in_transaction:
+            self.conn.execute('ROLLBACK')
+        self.conn.close()
+
+
+def _apply_changes(db_file, changes, deleted):
+    """Apply the notes and tags of an incremental backup to the database.
+
+    Incremental backups ship every notebook, so the notebooks table is replaced outright.
+    """
+    conn = sqlite3.connect(db_file)
+    with conn:
+        for uuid in deleted:
+            conn.execute('DELETE FROM `tags` WHERE `uuid` = ?', (uuid, ))
+            conn.execute('DELETE FROM `notes` WHERE `uuid` = ?', (uuid, ))
+        conn.execute('DELETE FROM `notebooks`')
+        _replace_rows(conn, 'notebooks', changes['notebooks'])
+        for note in changes['notes']:
+            conn.execute('DELETE FROM `tags` WHERE `uuid` = ?', (note['uuid'], ))
+        _replace_rows(conn, 'notes', changes['notes'])
+        _replace_rows(conn, 'tags', changes['tags'])
+    conn.close()
+
+
+def _file_path(clearfile_dir, name):
+    """Return where an archived file belongs, or None if it is not a note file."""
+    parts = name.split('/')
+    if len(parts) < 2 or parts[0] != FILES_DIR or parts[1:-1] not in ([], [THUMB_DIR]):
+        return None
+    filename = parts[-1]
+    if not filename or filename.startswith('.'):
+        return None
+    return os.path.join(clearfile_dir, *parts[1:])
+
+
+def _remove_note_files(clearfile_dir, uuids):
+    """Remove the original and thumbnail of each deleted note."""
+    for uuid in uuids:
+        if not uuid or uuid.startswith('.') or os.path.basename(uuid) != uuid:
+            continue
+        for directory in (clearfile_dir, os.path.join(clearfile_dir, THUMB_DIR)):
+            for path in glob.glob(os.path.join(glob.escape(directory),
+                                               glob.escape(uuid) + '.*')):
+                os.unlink(path)
+
+
+def import_archive(clearfile_dir, db_file, inp):
+    """Restore a backup archive read from the binary stream inp.
+
+    Incremental archives must be applied on top of the backup they were taken against.
+    Returns the archive's manifest.
+    """
+    manifest = None
+    restore = None
+    try:
+        with tarfile.open(fileobj=inp, mode='r|*') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                data = archive.extractfile(member)
+                if member.name == MANIFEST:
+                    manifest = json.load(data)
+                elif manifest is None:
+                    raise ValueError('Backup archive must begin with a manifest.')
+                elif member.name.startswith(DUMP + '.'):
+                    if restore is None:
+                        restore = _DumpRestore(db_file)
+                    restore.replay(int(member.name[len(DUMP) + 1:]), data)
+                elif member.name == NOTES:
+                    _apply_changes(db_file, json.load(data), manifest['deleted'])
+                else:
+                    path = _file_path(clearfile_dir, member.name)
+                    if path is None:
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    partial = path + '.part'
+                    with open(partial, 'wb') as out:
+                        shutil.copyfileobj(data, out)
+                    os.replace(partial, path)
+        if restore is not None and not restore.done:
+            raise ValueError('Backup archive ends part way through the database.')
+    finally:
+        if restore is not None:
+            restore.close()
+
+    if manifest is None:
+        raise ValueError('Backup archive is missing its manifest.')
+    _remove_note_files(clearfile_dir, set(manifest['deleted']))
+    return manifest
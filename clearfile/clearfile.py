@@ -10,12 +10,14 @@ import json
 import multiprocessing
 import uuid
 import mimetypes
+import tarfile
+import click
 from PIL import Image
 
 from flask import Flask, render_template, request, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
 
-from clearfile import db, note, thumbnail, ocr
+from clearfile import backup, db, note, thumbnail, ocr
 
 app = Flask(__name__)
 app.config.update(TEMPLATES_AUTO_RELOAD=True)
@@ -35,6 +37,7 @@ def setup_environments():
 setup_environments()
 db.create_db_if_not_exists(
     os.path.join(app.root_path, 'clearfile.sql'), app.config['DB_FILE'])
+db.load_indexes(dataset.connect(app.config['DB_URL']))
 
 
 class APIError(Exception):
@@ -102,6 +105,28 @@ def get_note(uuid):
         return json.dumps(nt, cls=note.NoteEncoder)
 
 
+SUGGESTION_INDEXES = {'tag': db.tag_index, 'notebook': db.notebook_index}
+
+
+@app.route('/suggest/<kind>', methods=['GET'])
+def suggest(kind):
+    """Suggest tags or notebook names (formatted as JSON) starting with a prefix.
+
+    Suggestions come from in-memory indexes and are sorted by how many notes use them.
+    """
+    if kind not in SUGGESTION_INDEXES:
+        raise APIError('Client must ask for either tag or notebook suggestions.')
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise APIError('Limit must be a positive integer.')
+    prefix = request.args.get('prefix', default='')
+    suggestions = SUGGESTION_INDEXES[kind].suggest(prefix, limit=limit)
+    return json.dumps([{'name': name, 'count': count} for name, count in suggestions])
+
+
 @app.route('/uploads/<uuid>', methods=['GET'])
 def uploads(uuid):
     """Show note image associated with note UUID."""
@@ -187,7 +212,8 @@ def handle_upload():
 
     conn = dataset.connect(app.config['DB_URL'])
     with conn:
-        db.add_note(conn, user_note)
+        changes = db.add_note(conn, user_note)
+    db.update_indexes(changes)
 
     if fetch_location:
         p = multiprocessing.Process(target=update_location, args=(user_note.uuid,gps_data))
@@ -206,7 +232,8 @@ def handle_delete_tag(tag_id):
 
     conn = dataset.connect(app.config['DB_URL'])
     with conn:
-        db.delete_tag(conn, tag_id)
+        changes = db.delete_tag(conn, tag_id)
+    db.update_indexes(changes)
 
     return ok()
 
@@ -218,7 +245,8 @@ def handle_delete(uuid):
     try:
         with conn:
             note = db.note_for_uuid(conn, uuid)
-            db.delete_note(conn, uuid)
+            changes = db.delete_note(conn, uuid)
+        db.update_indexes(changes)
         extension = mimetypes.guess_extension(note.mime)
         path = os.path.join(app.config['CLEARFILE_DIR'], uuid + extension)
         os.unlink(path)
@@ -235,7 +263,8 @@ def add_notebook():
     if notebook is None:
         raise APIError('Client must supply a valid notebook name.')
     with conn:
-        db.add_notebook(conn, notebook)
+        changes = db.add_notebook(conn, notebook)
+    db.update_indexes(changes)
     return ok()
 
 
@@ -254,5 +283,44 @@ def update():
         raise APIError('Client must supply UUID to server.')
     conn = dataset.connect(app.config['DB_URL'])
     with conn:
-        db.update_note(conn, data)
+        changes = db.update_note(conn, data)
+    db.update_indexes(changes)
     return ok()
+
+
+@app.cli.command('export')
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option(
+    '--checkpoint',
+    type=click.Path(dir_okay=False),
+    help='File recording the last export, only notes changed since are exported.')
+def export_notes(output, checkpoint):
+    """Stream a backup archive of notes and their files to OUTPUT (default stdout)."""
+    since = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            try:
+                since = int(f.read())
+            except ValueError:
+                raise click.ClickException(
+                    f'Checkpoint file {checkpoint} does not hold a checkpoint.')
+    latest = backup.export_archive(app.config['CLEARFILE_DIR'],
+                                   app.config['DB_FILE'], output, since=since)
+    output.flush()
+    if checkpoint:
+        with open(checkpoint, 'w') as f:
+            f.write(str(latest))
+    backup.compact_changes(app.config['DB_FILE'])
+
+
+@app.cli.command('import')
+@click.argument('input', type=click.File('rb'), default='-')
+def import_notes(input):
+    """Restore a backup archive made by export from INPUT (default stdin)."""
+    try:
+        backup.import_archive(app.config['CLEARFILE_DIR'], app.config['DB_FILE'],
+                              input)
+    except ValueError as e:
+        raise click.ClickException(e.args[0])
+    except tarfile.TarError as e:
+        raise click.ClickException(f'Invalid backup archive: {e}')
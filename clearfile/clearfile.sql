@@ -18,4 +18,29 @@ CREATE TABLE IF NOT EXISTS `notes` (
 	PRIMARY KEY(`uuid`),
   FOREIGN KEY(`notebook`) REFERENCES `notebooks`(`id`) ON DELETE SET NULL
 );
+-- Log of note changes, the row id acts as a checkpoint for incremental backups.
+CREATE TABLE IF NOT EXISTS `changes` (
+  `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+  `uuid` TEXT
+);
+CREATE TRIGGER IF NOT EXISTS `notes_insert_change` AFTER INSERT ON `notes`
+BEGIN
+  INSERT INTO `changes` (`uuid`) VALUES (NEW.`uuid`);
+END;
+CREATE TRIGGER IF NOT EXISTS `notes_update_change` AFTER UPDATE ON `notes`
+BEGIN
+  INSERT INTO `changes` (`uuid`) VALUES (NEW.`uuid`);
+END;
+CREATE TRIGGER IF NOT EXISTS `notes_delete_change` AFTER DELETE ON `notes`
+BEGIN
+  INSERT INTO `changes` (`uuid`) VALUES (OLD.`uuid`);
+END;
+CREATE TRIGGER IF NOT EXISTS `tags_insert_change` AFTER INSERT ON `tags`
+BEGIN
+  INSERT INTO `changes` (`uuid`) VALUES (NEW.`uuid`);
+END;
+CREATE TRIGGER IF NOT EXISTS `tags_delete_change` AFTER DELETE ON `tags`
+BEGIN
+  INSERT INTO `changes` (`uuid`) VALUES (OLD.`uuid`);
+END;
 COMMIT;
@@ -1,9 +1,14 @@
 """Manage notes in a directory."""
 import sqlite3
-import heapq
-from fuzzywuzzy import fuzz
+from functools import partial
 
-from clearfile import note
+from clearfile import note, rank, suggest
+
+# Distinct tags and notebook names with usage counts, so suggestions never have to scan
+# the tags table. Functions below that change tags or notebooks return the matching
+# index changes, which callers apply with update_indexes once their transaction commits.
+tag_index = suggest.PrefixIndex()
+notebook_index = suggest.PrefixIndex()
 
 
 def note_for_uuid(db, uuid):
@@ -34,32 +39,41 @@ def get_notes(db):
     return notes
 
 
-def rank_note(query, note):
-    """Rank a note's similarity to a query (max of match on title and text)."""
-    match_ocr = fuzz.WRatio(query, note.ocr_text)
-    match_title = fuzz.WRatio(query, note.name)
-    return max(match_ocr, match_title)
-
-
 def note_search(conn, search, notebook=None, at=None):
     """Search notes in database based on a query."""
-    notes = get_notes(conn)
-    filtered_notes = []
+    notebooks = {nb.id: nb for nb in get_notebooks(conn)}
+    candidates = []
 
-    for n in notes:
-        if at and n.location != at:
+    for result in conn['notes'].all():
+        nb = notebooks.get(result.get('notebook'))
+        if at and result.get('location') != at:
             continue
-        elif notebook and n.notebook is None:
+        elif notebook and nb is None:
             continue
-        elif notebook and n.notebook and n.notebook.name.lower() != notebook.lower():
+        elif notebook and nb.name.lower() != notebook.lower():
             continue
-        else:
-            score = rank_note(search, n)
-            if search == '' or score > 50:
-                filtered_notes.append((score, n))
+        candidates.append(result)
+
+    if search == '':
+        top = candidates[:10]
+    else:
+        ranked = rank.Ranker(search).rank(
+            [(result['name'], result['ocr_text']) for result in candidates])
+        top = [candidates[i] for _, i in ranked]
+
+    notes = []
+    for result in top:
+        if result.get('notebook', None):
+            result['notebook'] = notebooks.get(result['notebook'])
+        tags = get_tags_for_note(conn, result['uuid'])
+        notes.append(note.Note(**result, tags=tags))
+    return notes
+
 
-    largest = heapq.nlargest(10, filtered_notes, key=lambda r: r[0])
-    return [nt for _, nt in largest]
+def update_indexes(changes):
+    """Apply index changes returned by the functions below, after they are committed."""
+    for change in changes:
+        change()
 
 
 def add_tags(db, *tags):
@@ -68,6 +82,7 @@ def add_tags(db, *tags):
         'uuid': tag.uuid,
         'tag': tag.tag
     } for tag in tags])
+    return [partial(tag_index.add, tag.tag) for tag in tags]
 
 
 def add_note(db, user_note):
@@ -79,50 +94,80 @@ def add_note(db, user_note):
             ocr_text=user_note.ocr_text,
             mime=user_note.mime,
             location=user_note.location))
-    add_tags(db, *user_note.tags)
+    return add_tags(db, *user_note.tags)
 
 
 def update_tags(db, nt, new_tags):
     """Update tags of note within database, only including changes to tag set."""
     old_tags = {tag.tag for tag in nt.tags}
     new_tags = set(new_tags)
+    removed = old_tags - new_tags
 
-    for tag in new_tags ^ old_tags:
-        if tag in new_tags:
-            new_tag = note.Tag(None, nt.uuid, tag)
-            add_tags(db, new_tag)
-        elif tag in old_tags:
-            db['tags'].delete(tag=tag, uuid=nt.uuid)
+    for tag in removed:
+        db['tags'].delete(tag=tag, uuid=nt.uuid)
+    changes = add_tags(db, *(note.Tag(None, nt.uuid, tag) for tag in new_tags - old_tags))
+    return changes + [partial(tag_index.remove, tag) for tag in removed]
 
 
 def update_note(db, data):
     """Update data of note within database."""
     old_note = note_for_uuid(db, data['uuid'])
-    if 'tags' in data:
-        update_tags(db, old_note, data['tags'])
-        data.pop('tags')
-    if 'notebook' in data and old_note.notebook and data['notebook'] != old_note.notebook:
-        notes_left = db['notes'].find(notebook=old_note.notebook.id)
+    tags = data.pop('tags', None)
+    old_notebook = old_note.notebook
+    new_notebook = None
+    moved = False
+    if 'notebook' in data:
+        # Clients send notebook ids as strings.
+        try:
+            if data['notebook'] is not None:
+                data['notebook'] = int(data['notebook'])
+        except ValueError:
+            pass
+        moved = data['notebook'] != (old_notebook.id if old_notebook else None)
+        if moved and data['notebook'] is not None:
+            found = db['notebooks'].find_one(id=data['notebook'])
+            new_notebook = note.Notebook(**found) if found else None
+    emptied = False
+    if moved and old_notebook:
+        notes_left = db['notes'].find(notebook=old_notebook.id)
         if len(list(notes_left)) == 1:
-            db['notebooks'].delete(id=old_note.notebook.id)
+            db['notebooks'].delete(id=old_notebook.id)
+            emptied = True
     db['notes'].update(data, ['uuid'])
+    changes = []
+    if tags is not None:
+        changes += update_tags(db, old_note, tags)
+    if moved and old_notebook:
+        if emptied:
+            changes.append(partial(notebook_index.discard, old_notebook.name))
+        else:
+            changes.append(partial(notebook_index.remove, old_notebook.name, prune=False))
+    if new_notebook:
+        changes.append(partial(notebook_index.add, new_notebook.name))
+    return changes
 
 
 def remove_note_from_notebook(db, uuid):
     """Remove note from database."""
+    old_note = note_for_uuid(db, uuid)
     data = {'uuid': uuid, 'notebook': None}
     db['notes'].update(data, ['uuid'])
+    if old_note.notebook:
+        return [partial(notebook_index.remove, old_note.notebook.name, prune=False)]
+    return []
 
 
 def delete_notebook(db, notebook):
     """Delete notebook from database, cascading changes onto all notes."""
     db.query('PRAGMA foreign_keys=ON')
     db['notebooks'].delete(name=notebook)
+    return [partial(notebook_index.discard, notebook)]
 
 
 def add_notebook(db, notebook):
     """Insert new notebook into database."""
     db['notebooks'].insert(dict(name=notebook))
+    return [partial(notebook_index.add, notebook, count=0)]
 
 
 def notebook_for_id(db, id):
@@ -133,8 +178,13 @@ def notebook_for_id(db, id):
 
 def delete_note(db, uuid):
     """Delete note from database, and associated tags."""
+    old_note = note_for_uuid(db, uuid)
     db.query('PRAGMA foreign_keys=ON')
     db['notes'].delete(uuid=uuid)
+    changes = [partial(tag_index.remove, tag.tag) for tag in old_note.tags]
+    if old_note.notebook:
+        changes.append(partial(notebook_index.remove, old_note.notebook.name, prune=False))
+    return changes
 
 
 def get_notebooks(db):
@@ -144,7 +194,23 @@ def get_notebooks(db):
 
 def delete_tag(db, tag_id):
     """Delete tag from the database."""
+    tag = db['tags'].find_one(id=tag_id)
     db['tags'].delete(id=tag_id)
+    if tag is not None:
+        return [partial(tag_index.remove, tag['tag'])]
+    return []
+
+
+def load_indexes(db):
+    """Rebuild the tag and notebook suggestion indexes from the database."""
+    tag_index.load(
+        (row['tag'], row['uses'])
+        for row in db.query('SELECT tag, COUNT(*) AS uses FROM tags GROUP BY tag'))
+    notebook_index.load(
+        (row['name'], row['uses'])
+        for row in db.query('SELECT notebooks.name AS name, COUNT(notes.uuid) AS uses '
+                            'FROM notebooks LEFT JOIN notes '
+                            'ON notes.notebook = notebooks.id GROUP BY notebooks.id'))
 
 
 def create_db_if_not_exists(schema_file, db_file):
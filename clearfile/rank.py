@@ -0,0 +1,174 @@
+"""Rank notes against a search query.
+
+Scores are the same as fuzz.WRatio (the best of a note's title and text), but the query
+is processed once per search and comparisons that cannot get a note into the top results
+are skipped.
+"""
+import heapq
+from fuzzywuzzy import fuzz, utils
+
+# Notes must score above this to match a query.
+SCORE_CUTOFF = 50
+# Only this many characters of a note's text are compared with the query.
+TEXT_LIMIT = 10000
+
+
+def process(text):
+    """Normalize text the same way fuzz.WRatio does before comparing it."""
+    return utils.full_process(text or '', force_ascii=True)
+
+
+# ASCII characters full_process turns into whitespace, and so strips from either end.
+NON_WORD = ''.join(chr(c) for c in range(128) if not (chr(c).isalnum() or chr(c) == '_'))
+
+
+def processed_length(text):
+    """Return len(process(text)) without processing text, or None if it can't be told.
+
+    For ASCII text processing only replaces non-word characters with spaces, lowercases
+    and strips, so the length is that of the text without non-word characters at its ends.
+    """
+    if not text.isascii():
+        return None
+    return len(text.strip(NON_WORD))
+
+
+def score_bound(query_length, text_length):
+    """Return an upper bound on fuzz.WRatio for processed strings of the given lengths.
+
+    WRatio is the best of a plain ratio, which is limited by the difference in length,
+    and partial ratios scaled down the more the lengths differ.
+    """
+    shorter, longer = sorted((query_length, text_length))
+    if shorter == 0:
+        return 0
+    len_ratio = longer / shorter
+    if len_ratio < 1.5:
+        partial = 100
+    elif len_ratio > 8:
+        partial = 60
+    else:
+        partial = 90
+    return utils.intr(max(200 * shorter / (shorter + longer), partial))
+
+
+def wratio(p1, p2, threshold=0):
+    """Return fuzz.WRatio of two processed strings.
+
+    Mirrors WRatio, but comparisons that cannot raise the score above threshold (or
+    above the best comparison so far) are skipped, so scores at or below threshold may
+    be lower than WRatio's.
+    """
+    if not utils.validate_string(p1) or not utils.validate_string(p2):
+        return 0
+    best = fuzz.ratio(p1, p2)
+    len_ratio = float(max(len(p1), len(p2))) / min(len(p1), len(p2))
+
+    # Strings of similar length are compared by whole token ratios, scaled to 95 at most.
+    if len_ratio < 1.5:
+        for ratio in (fuzz.token_sort_ratio, fuzz.token_set_ratio):
+            if 95 <= max(best, threshold):
+                break
+            best = max(best, ratio(p1, p2, full_process=False) * .95)
+        return utils.intr(best)
+
+    scale = .6 if len_ratio > 8 else .9
+    # A shared token makes partial_token_set_ratio 100, no need to compute it.
+    shared = not set(p1.split()).isdisjoint(p2.split())
+    if shared:
+        best = max(best, 100 * .95 * scale)
+    if 100 * scale > max(best, threshold):
+        best = max(best, fuzz.partial_ratio(p1, p2) * scale)
+    if 100 * .95 * scale > max(best, threshold):
+        best = max(best,
+                   fuzz.partial_token_sort_ratio(p1, p2, full_process=False) * .95 * scale)
+    if not shared and 100 * .95 * scale > max(best, threshold):
+        best = max(best,
+                   fuzz.partial_token_set_ratio(p1, p2, full_process=False) * .95 * scale)
+    return utils.intr(best)
+
+
+class Ranker(object):
+    """Scores notes against a single preprocessed query."""
+
+    def __init__(self, query, cutoff=SCORE_CUTOFF):
+        """Initialize ranker, notes must score above cutoff to be ranked."""
+        self.query = process(query)
+        self.cutoff = cutoff
+
+    def text_score(self, text, threshold=0):
+        """Return the match of the query on a note's text.
+
+        Text that cannot score above threshold is not compared, so scores at or below
+        threshold may be lower than the text's true score.
+        """
+        text = (text or '')[:TEXT_LIMIT]
+        # Most texts can be ruled out by length before paying to process them.
+        length = processed_length(text)
+        if length is not None and score_bound(len(self.query), length) <= threshold:
+            return 0
+        text = process(text)
+        bound = score_bound(len(self.query), len(text))
+        if bound == 60:
+            # Past 8 times the length only partial_ratio scores 100, and so WRatio 60,
+            # which for strings of up to 100 characters needs the shorter one whole.
+            shorter, longer = sorted((self.query, text), key=len)
+            if len(shorter) <= 100 and shorter not in longer:
+                bound = 59
+        if bound <= threshold:
+            return 0
+        return wratio(self.query, text, threshold)
+
+    def score(self, title, text, threshold=0):
+        """Return the match of the query on a note's title and text.
+
+        Scores at or below threshold may be lower than the note's true score.
+        """
+        title_score = wratio(self.query, process(title), threshold)
+        return max(title_score,
+                   self.text_score(text, max(threshold, title_score)))
+
+    def rank(self, candidates, k=10):
+        """Return the k best (score, index) pairs of (title, text) candidates.
+
+        Ties go to the earlier candidate. Titles are scored first, their scores are lower
+        bounds that let most texts be skipped.
+        """
+        heap = []
+        title_scores = []
+        for i, (title, _) in enumerate(candidates):
+            score = wratio(self.query, process(title), self.cutoff)
+            title_scores.append(score)
+            if score > self.cutoff:
+                _push(heap, (score, -i), k)
+
+        for i, (title_score, (_, text)) in enumerate(zip(title_scores, candidates)):
+            if len(heap) < k:
+                threshold = self.cutoff
+            else:
+                # A note can tie the lowest of the top scores and still beat it on order.
+                threshold, j = heap[0][0], -heap[0][1]
+                if i < j:
+                    threshold -= 1
+            threshold = max(threshold, title_score)
+            score = self.text_score(text, threshold)
+            if score <= threshold:
+                continue
+            for n, (_, entry) in enumerate(heap):
+                if entry == -i:
+                    heap[n] = (score, -i)
+                    heapq.heapify(heap)
+                    break
+            else:
+                _push(heap, (score, -i), k)
+        return sorted(((score, -i) for score, i in heap),
+                      key=lambda r: (-r[0], r[1]))
+
+
+def _push(heap, item, k):
+    """Push item onto a heap of at most k items, dropping the smallest."""
+    if len(heap) < k:
+        heapq.heappush(heap, item)
+    else:
+        heapq.heappushpop(heap, item)
+
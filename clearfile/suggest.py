@@ -0,0 +1,140 @@
+"""In-memory prefix index used to suggest tags and notebook names as the user types."""
+import bisect
+import heapq
+import threading
+
+# Prefixes up to this long keep their terms ranked by usage, longer ones are searched.
+RANKED_PREFIX = 2
+
+
+class PrefixIndex(object):
+    """Sorted array of distinct terms with usage counts, searchable by prefix.
+
+    Terms are matched case insensitively. Short prefixes match too many terms to rank
+    on every lookup, so the terms under each of them are also kept sorted by usage.
+    Longer prefixes bisect to the first matching term and walk forward. Lookups never
+    touch the database.
+    """
+
+    def __init__(self):
+        """Initialize an empty index."""
+        self._keys = []
+        self._counts = {}
+        self._ranked = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, term):
+        return term in self._counts
+
+    def count(self, term):
+        """Return the usage count of a term (0 if the term is not indexed)."""
+        return self._counts.get(term, 0)
+
+    def add(self, term, count=1):
+        """Increase the usage count of term, indexing it if it is new.
+
+        A count of 0 indexes the term without marking it as used.
+        """
+        if not term:
+            return
+        with self._lock:
+            if term in self._counts:
+                self._unrank(term)
+            else:
+                key = (term.lower(), term)
+                self._keys.insert(bisect.bisect_left(self._keys, key), key)
+                self._counts[term] = 0
+            self._counts[term] += count
+            self._rank(term)
+
+    def remove(self, term, count=1, prune=True):
+        """Decrease the usage count of term, dropping it once unused if prune is set."""
+        with self._lock:
+            if term not in self._counts:
+                return
+            self._unrank(term)
+            self._counts[term] = max(self._counts[term] - count, 0)
+            if prune and self._counts[term] == 0:
+                self._discard(term)
+            else:
+                self._rank(term)
+
+    def discard(self, term):
+        """Remove term from the index regardless of its usage count."""
+        with self._lock:
+            if term in self._counts:
+                self._unrank(term)
+                self._discard(term)
+
+    def _discard(self, term):
+        i = bisect.bisect_left(self._keys, (term.lower(), term))
+        del self._keys[i]
+        del self._counts[term]
+
+    def _ranked_key(self, term):
+        return (-self._counts[term], term.lower(), term)
+
+    def _short_prefixes(self, term):
+        key = term.lower()
+        return [key[:n] for n in range(min(len(key), RANKED_PREFIX) + 1)]
+
+    def _rank(self, term):
+        key = self._ranked_key(term)
+        for prefix in self._short_prefixes(term):
+            bisect.insort(self._ranked.setdefault(prefix, []), key)
+
+    def _unrank(self, term):
+        key = self._ranked_key(term)
+        for prefix in self._short_prefixes(term):
+            ranked = self._ranked[prefix]
+            del ranked[bisect.bisect_left(ranked, key)]
+            if not ranked:
+                del self._ranked[prefix]
+
+    def load(self, pairs):
+        """Replace the contents of the index with (term, count) pairs.
+
+        The sorted arrays are built with one sort each, instead of inserting terms one
+        at a time as add does.
+        """
+        counts = {}
+        for term, count in pairs:
+            if term:
+                counts[term] = counts.get(term, 0) + count
+        keys = sorted((term.lower(), term) for term in counts)
+        ranked = {}
+        for term, count in counts.items():
+            key = (-count, term.lower(), term)
+            for prefix in self._short_prefixes(term):
+                ranked.setdefault(prefix, []).append(key)
+        for terms in ranked.values():
+            terms.sort()
+        with self._lock:
+            self._keys, self._counts, self._ranked = keys, counts, ranked
+
+    def clear(self):
+        """Remove every term from the index."""
+        with self._lock:
+            self._keys.clear()
+            self._counts.clear()
+            self._ranked.clear()
+
+    def suggest(self, prefix, limit=10):
+        """Return up to limit (term, count) pairs starting with prefix, most used first."""
+        prefix = prefix.lower()
+        with self._lock:
+            if len(prefix) <= RANKED_PREFIX:
+                matches = self._ranked.get(prefix, [])[:limit]
+            else:
+                start = bisect.bisect_left(self._keys, (prefix, ))
+                matches = []
+                for i in range(start, len(self._keys)):
+                    key, term = self._keys[i]
+                    if not key.startswith(prefix):
+                        break
+                    matches.append(self._ranked_key(term))
+                matches = heapq.nsmallest(limit, matches)
+        return [(term, -count) for count, _, term in matches]
@@ -0,0 +1,257 @@
+"""Round trip tests for streaming backups and the change log behind incremental ones."""
+import io
+import os
+import sqlite3
+import tarfile
+
+import pytest
+
+from clearfile import backup
+
+SCHEMA = os.path.join(os.path.dirname(backup.__file__), 'clearfile.sql')
+TEXTS = [
+    'plain text',
+    "statement-like text;\nDROP TABLE `notes`;\n",
+    "quotes ' and \"double\" quotes;\r\nand a carriage return",
+    'unicode caf\xe9 ☃ \U0001f4dd; split across chunks;\n' * 20,
+]
+
+
+def make_clearfile(directory):
+    """Create a clearfile directory with an empty database, as the server does."""
+    os.makedirs(os.path.join(directory, backup.THUMB_DIR))
+    db_file = os.path.join(directory, 'clearfile.db')
+    conn = sqlite3.connect(db_file)
+    with conn:
+        with open(SCHEMA) as f:
+            conn.executescript(f.read())
+    conn.close()
+    return db_file
+
+
+def add_note(directory, conn, uuid, mime='image/jpeg', notebook=None, text='', tags=()):
+    """Insert a note with tags and write its files."""
+    conn.execute(
+        'INSERT INTO `notes` (`uuid`, `name`, `ocr_text`, `mime`, `notebook`) '
+        'VALUES (?, ?, ?, ?, ?)', (uuid, f'Note {uuid}', text, mime, notebook))
+    for tag in tags:
+        conn.execute('INSERT INTO `tags` (`uuid`, `tag`) VALUES (?, ?)', (uuid, tag))
+    for rel in backup.note_files(uuid, mime):
+        with open(os.path.join(directory, rel), 'wb') as f:
+            f.write(f'{uuid}:{rel}'.encode('utf-8'))
+
+
+def rows(db_file):
+    """Return the notes, tags and notebooks of a database."""
+    conn = sqlite3.connect(db_file)
+    tables = {
+        table: conn.execute(f'SELECT * FROM `{table}` ORDER BY 1').fetchall()
+        for table in ('notes', 'tags', 'notebooks')
+    }
+    conn.close()
+    return tables
+
+
+def files(directory):
+    """Return the contents of every file in a clearfile directory except the database."""
+    contents = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if name != 'clearfile.db':
+                with open(path, 'rb') as f:
+                    contents[os.path.relpath(path, directory)] = f.read()
+    return contents
+
+
+def export(directory, db_file, since=None):
+    out = io.BytesIO()
+    checkpoint = backup.export_archive(directory, db_file, out, since=since)
+    return out.getvalue(), checkpoint
+
+
+def import_(directory, db_file, archive):
+    return backup.import_archive(directory, db_file, io.BytesIO(archive))
+
+
+@pytest.fixture
+def source(tmpdir):
+    directory = str(tmpdir.join('source'))
+    db_file = make_clearfile(directory)
+    conn = sqlite3.connect(db_file)
+    with conn:
+        # dataset adds columns to notes the first time they are written.
+        conn.execute('ALTER TABLE `notes` ADD COLUMN `location` TEXT')
+        conn.execute("INSERT INTO `notebooks` (`name`) VALUES ('maths'), ('physics')")
+        for i, text in enumerate(TEXTS):
+            add_note(directory, conn, f'note-{i}', notebook=1, text=text,
+                     tags=['calculus', f'tag-{i}'])
+        add_note(directory, conn, 'pdf-note', mime='application/pdf', notebook=2,
+                 text='a pdf', tags=['pdf'])
+        add_note(directory, conn, 'doomed', mime='application/pdf', tags=['bin'])
+    conn.close()
+    return directory, db_file
+
+
+def test_change_triggers(source):
+    directory, db_file = source
+    conn = sqlite3.connect(db_file)
+    since = backup.checkpoint_of(conn)
+    assert backup.changed_since(conn, since) == set()
+    with conn:
+        add_note(directory, conn, 'new-note')
+        conn.execute("UPDATE `notes` SET `name` = 'Renamed' WHERE `uuid` = 'note-0'")
+        conn.execute("DELETE FROM `notes` WHERE `uuid` = 'note-1'")
+        conn.execute("INSERT INTO `tags` (`uuid`, `tag`) VALUES ('note-2', 'extra')")
+        conn.execute("DELETE FROM `tags` WHERE `uuid` = 'note-3'")
+    assert backup.changed_since(conn, since) == {
+        'new-note', 'note-0', 'note-1', 'note-2', 'note-3'
+    }
+    conn.close()
+
+
+def test_compact_changes_keeps_checkpoints(source):
+    directory, db_file = source
+    conn = sqlite3.connect(db_file)
+    first = backup.checkpoint_of(conn)
+    with conn:
+        for name in ('one', 'two', 'three'):
+            conn.execute('UPDATE `notes` SET `name` = ? WHERE `uuid` = ?', (name, 'note-0'))
+        conn.execute("DELETE FROM `notes` WHERE `uuid` = 'doomed'")
+    second = backup.checkpoint_of(conn)
+    with conn:
+        conn.execute("UPDATE `notes` SET `name` = 'four' WHERE `uuid` = 'note-1'")
+    latest = backup.checkpoint_of(conn)
+    conn.close()
+
+    backup.compact_changes(db_file)
+    conn = sqlite3.connect(db_file)
+    assert conn.execute('SELECT COUNT(*) FROM `changes`').fetchone()[0] == len(
+        TEXTS) + 2
+    assert backup.checkpoint_of(conn) == latest
+    assert backup.changed_since(conn, first) == {'note-0', 'doomed', 'note-1'}
+    assert backup.changed_since(conn, second) == {'note-1'}
+    assert backup.changed_since(conn, latest) == set()
+    conn.close()
+
+
+@pytest.mark.parametrize('chunk_size', [backup.DUMP_CHUNK_SIZE, 7, 64])
+def test_full_and_incremental_round_trip(source, tmpdir, monkeypatch, chunk_size):
+    monkeypatch.setattr(backup, 'DUMP_CHUNK_SIZE', chunk_size)
+    directory, db_file = source
+    full, checkpoint = export(directory, db_file)
+
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute("UPDATE `notes` SET `name` = 'Edited', `location` = 'Library' "
+                     "WHERE `uuid` = 'note-0'")
+        conn.execute("DELETE FROM `tags` WHERE `uuid` = 'note-0' AND `tag` = 'calculus'")
+        conn.execute("DELETE FROM `tags` WHERE `uuid` = 'doomed'")
+        conn.execute("DELETE FROM `notes` WHERE `uuid` = 'doomed'")
+        # Notes are moved out of a notebook before it is deleted, see db.update_note.
+        conn.execute("UPDATE `notes` SET `notebook` = NULL WHERE `uuid` = 'pdf-note'")
+        conn.execute("DELETE FROM `notebooks` WHERE `name` = 'physics'")
+        conn.execute("INSERT INTO `notebooks` (`name`) VALUES ('history')")
+        add_note(directory, conn, 'added', notebook=3, text=TEXTS[1], tags=['essay'])
+    conn.close()
+    os.unlink(os.path.join(directory, 'doomed.pdf'))
+    os.unlink(os.path.join(directory, backup.THUMB_DIR, 'doomed.jpe'))
+    with open(os.path.join(directory, 'note-0.jpg'), 'wb') as f:
+        f.write(b'rotated image')
+    incremental, latest = export(directory, db_file, since=checkpoint)
+    assert latest > checkpoint
+
+    restored = str(tmpdir.join('restored'))
+    restored_db = make_clearfile(restored)
+    manifest = import_(restored, restored_db, full)
+    assert manifest['checkpoint'] == checkpoint
+    assert 'doomed.pdf' in files(restored)
+    manifest = import_(restored, restored_db, incremental)
+    assert manifest['deleted'] == ['doomed']
+
+    assert rows(restored_db) == rows(db_file)
+    assert files(restored) == files(directory)
+
+
+def test_full_dump_members(source, monkeypatch):
+    monkeypatch.setattr(backup, 'DUMP_CHUNK_SIZE', 100)
+    directory, db_file = source
+    archive, _ = export(directory, db_file)
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        members = tar.getmembers()
+    names = [member.name for member in members]
+    dumps = [member for member in members if member.name.startswith(backup.DUMP)]
+    assert names[0] == backup.MANIFEST
+    assert [member.name for member in dumps] == [
+        f'{backup.DUMP}.{i:03d}' for i in range(len(dumps))
+    ]
+    assert len(dumps) > 1
+    assert all(member.size <= 100 for member in dumps)
+
+
+def test_truncated_dump_leaves_database(source, tmpdir, monkeypatch):
+    monkeypatch.setattr(backup, 'DUMP_CHUNK_SIZE', 100)
+    directory, db_file = source
+    archive, _ = export(directory, db_file)
+    restored = str(tmpdir.join('restored'))
+    restored_db = make_clearfile(restored)
+    conn = sqlite3.connect(restored_db)
+    with conn:
+        add_note(restored, conn, 'existing', tags=['kept'])
+    conn.close()
+    before = rows(restored_db)
+
+    out = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar, \
+            tarfile.open(fileobj=out, mode='w|') as truncated:
+        for member in tar.getmembers():
+            if member.name == f'{backup.DUMP}.003':
+                break
+            truncated.addfile(member, tar.extractfile(member))
+    with pytest.raises(ValueError):
+        import_(restored, restored_db, out.getvalue())
+    assert rows(restored_db) == before
+
+
+def test_import_requires_manifest(tmpdir):
+    directory = str(tmpdir)
+    db_file = make_clearfile(directory)
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w|') as tar:
+        backup._add_json(tar, backup.NOTES, {'notes': [], 'tags': [], 'notebooks': []})
+    with pytest.raises(ValueError):
+        import_(directory, db_file, out.getvalue())
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('files/note.jpg', 'note.jpg'),
+    ('files/thumb/note.jpe', os.path.join('thumb', 'note.jpe')),
+    ('files/../note.jpg', None),
+    ('files/thumb/../../note.jpg', None),
+    ('files/other/note.jpg', None),
+    ('../files/note.jpg', None),
+    ('/files/note.jpg', None),
+    ('files/.hidden', None),
+    ('files/', None),
+    ('files/..', None),
+    ('note.jpg', None),
+])
+def test_file_path(tmpdir, name, expected):
+    path = backup._file_path(str(tmpdir), name)
+    if expected is None:
+        assert path is None
+    else:
+        assert path == os.path.join(str(tmpdir), expected)
+
+
+def test_remove_note_files(tmpdir):
+    directory = str(tmpdir.join('clearfile'))
+    make_clearfile(directory)
+    for rel in ('gone.jpg', 'gone-not.jpg', 'kept.pdf', 'thumb/gone.jpe', 'thumb/kept.jpe'):
+        with open(os.path.join(directory, rel), 'wb') as f:
+            f.write(b'')
+    with open(str(tmpdir.join('outside.jpg')), 'wb') as f:
+        f.write(b'')
+    backup._remove_note_files(directory, {'gone', '../outside', '..', ''})
+    assert set(files(directory)) == {'gone-not.jpg', 'kept.pdf', 'thumb/kept.jpe'}
+    assert tmpdir.join('outside.jpg').check()
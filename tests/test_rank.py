@@ -0,0 +1,98 @@
+"""Golden tests checking the ranking engine against the original fuzz.WRatio ranking."""
+import heapq
+import random
+
+import pytest
+from fuzzywuzzy import fuzz
+
+from clearfile import rank
+
+NOTES = [
+    ('Calculus lecture 4', 'The derivative of a function measures its rate of change.'),
+    ('Integration by parts', 'integral u dv = uv - integral v du; choose u by LIATE'),
+    ('Chemistry lab', 'Titration of HCl with NaOH, phenolphthalein indicator'),
+    ('Essay plan', 'History essay: causes of the First World War, alliances, militarism'),
+    ('Matrix notes', 'A matrix is invertible iff its determinant is non-zero.'),
+    ('Shopping', ''),
+    ('Physics', 'Energy is conserved. Kinetic energy = 1/2 m v^2. ' * 40),
+    ('Vectors', 'Dot product, cross product, vector spaces and linear maps.'),
+    ('Biology', 'Cell membrane proteins; mitochondria produce ATP.'),
+    ('Calculus exam', 'Limits, continuity, derivatives and integrals. Revise series.'),
+    ('Receipt', 'TOTAL $12.50 CASH $20.00 CHANGE $7.50'),
+    ('Untitled', 'calculus calculus calculus'),
+]
+
+QUERIES = [
+    'calculus', 'Calculus lecture', 'matrix determinant', 'energy', 'integral!',
+    'history essay', 'atp', 'cash', 'xyz', 'a', 'derivative of a function',
+    'vector spaces and linear maps', 'Cell', '12.50'
+]
+
+
+def reference_rank(query, candidates, k=10):
+    """Rank candidates the way note_search did before the ranking engine."""
+    scored = []
+    for i, (title, text) in enumerate(candidates):
+        score = max(fuzz.WRatio(query, text), fuzz.WRatio(query, title))
+        if score > rank.SCORE_CUTOFF:
+            scored.append((score, i))
+    return heapq.nlargest(k, scored, key=lambda r: r[0])
+
+
+def random_notes(n, seed=0):
+    """Generate notes with titles and texts of very different lengths."""
+    rng = random.Random(seed)
+    words = [w.lower() for title, text in NOTES for w in (title + ' ' + text).split()]
+    words += [
+        ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9)))
+        for _ in range(300)
+    ]
+    return [(' '.join(rng.choices(words, k=rng.randint(1, 4))),
+             ' '.join(rng.choices(words, k=rng.choice([0, 2, 8, 40, 200]))))
+            for _ in range(n)]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_golden_notes(query):
+    assert rank.Ranker(query).rank(NOTES) == reference_rank(query, NOTES)
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_random_notes(query):
+    notes = random_notes(400)
+    assert rank.Ranker(query).rank(notes) == reference_rank(query, notes)
+
+
+def test_wratio_matches_fuzz():
+    rng = random.Random(2)
+    strings = [text for note in random_notes(200, seed=2) for text in note]
+    for _ in range(2000):
+        p1 = rank.process(rng.choice(strings + QUERIES))
+        p2 = rank.process(rng.choice(strings))
+        assert rank.wratio(p1, p2) == fuzz.WRatio(p1, p2)
+
+
+def test_text_limit(monkeypatch):
+    monkeypatch.setattr(rank, 'TEXT_LIMIT', 20)
+    ranker = rank.Ranker('needle')
+    assert ranker.score('title', 'needle in a haystack') > rank.SCORE_CUTOFF
+    assert ranker.score('title', 'haystack ' * 10 + 'needle') <= rank.SCORE_CUTOFF
+
+
+@pytest.mark.parametrize('text', [
+    '', '  ', 'plain text', '  --Title: notes!-- ', '_under_', 'tab\tand\nnewline\r\n',
+    '$12.50;', 'caf\xe9'
+])
+def test_processed_length(text):
+    length = rank.processed_length(text)
+    assert length is None or length == len(rank.process(text))
+
+
+def test_long_text_bound():
+    texts = [text for _, text in random_notes(300, seed=3) if text]
+    for query in QUERIES + ['zzzz', 'energy is conserved']:
+        ranker = rank.Ranker(query)
+        for text in texts:
+            p = rank.process(text)
+            if len(p) > 8 * len(ranker.query) and ranker.query not in p:
+                assert fuzz.WRatio(ranker.query, p) <= 59
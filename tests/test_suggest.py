@@ -0,0 +1,160 @@
+"""Tests for the prefix index behind /suggest and its upkeep by the db functions."""
+import os
+import random
+
+import dataset
+import pytest
+
+from clearfile import db, note, suggest
+
+SCHEMA = os.path.join(os.path.dirname(db.__file__), 'clearfile.sql')
+
+
+def brute_force(counts, prefix, limit):
+    """Suggest the way PrefixIndex should, by sorting every matching term."""
+    matches = [(term, count) for term, count in counts.items()
+               if term.lower().startswith(prefix.lower())]
+    return sorted(matches, key=lambda m: (-m[1], m[0].lower(), m[0]))[:limit]
+
+
+def contents(index):
+    return sorted(index.suggest('', limit=len(index) + 1))
+
+
+def test_add_remove_discard():
+    index = suggest.PrefixIndex()
+    index.add('Calculus')
+    index.add('calculus', count=3)
+    index.add('chemistry', count=2)
+    index.add('')
+    assert len(index) == 3
+    assert index.suggest('c') == [('calculus', 3), ('chemistry', 2), ('Calculus', 1)]
+    assert index.suggest('CALC') == [('calculus', 3), ('Calculus', 1)]
+
+    index.remove('calculus', count=2)
+    assert index.suggest('ca') == [('Calculus', 1), ('calculus', 1)]
+    index.remove('Calculus')
+    assert 'Calculus' not in index
+    assert index.suggest('ca') == [('calculus', 1)]
+    index.remove('missing')
+    index.discard('missing')
+
+    index.remove('chemistry', count=5, prune=False)
+    assert index.count('chemistry') == 0
+    assert index.suggest('ch') == [('chemistry', 0)]
+    index.add('chemistry', count=0)
+    assert index.suggest('ch') == [('chemistry', 0)]
+    index.discard('chemistry')
+    assert index.suggest('ch') == []
+    assert index.suggest('') == [('calculus', 1)]
+
+    index.clear()
+    assert len(index) == 0
+    assert index.suggest('') == []
+
+
+@pytest.mark.parametrize('prefix', ['', 'm', 'ma', 'mat', 'math', 'mathematics', 'x'])
+def test_ordering(prefix):
+    index = suggest.PrefixIndex()
+    counts = {'maths': 5, 'Maths': 5, 'matrices': 7, 'mat': 1, 'mass': 7, 'm': 2,
+              'mathematics': 3, 'physics': 9}
+    for term, count in counts.items():
+        index.add(term, count)
+    assert index.suggest(prefix, limit=4) == brute_force(counts, prefix, 4)
+    assert index.suggest(prefix, limit=100) == brute_force(counts, prefix, 100)
+
+
+def test_random_operations():
+    rng = random.Random(0)
+    terms = [''.join(rng.choices('abAB', k=rng.randint(1, 5))) for _ in range(200)]
+    index = suggest.PrefixIndex()
+    counts = {}
+    for _ in range(5000):
+        term = rng.choice(terms)
+        operation = rng.random()
+        if operation < 0.5:
+            index.add(term)
+            counts[term] = counts.get(term, 0) + 1
+        elif operation < 0.8:
+            index.remove(term)
+            if term in counts:
+                counts[term] = max(counts[term] - 1, 0)
+                if counts[term] == 0:
+                    del counts[term]
+        elif operation < 0.95:
+            index.remove(term, prune=False)
+            if term in counts:
+                counts[term] = max(counts[term] - 1, 0)
+        else:
+            index.discard(term)
+            counts.pop(term, None)
+        prefix = rng.choice(terms)[:rng.randint(0, 4)]
+        assert index.suggest(prefix, limit=5) == brute_force(counts, prefix, 5)
+    loaded = suggest.PrefixIndex()
+    loaded.load(counts.items())
+    assert contents(loaded) == contents(index)
+    for prefix in ('', 'a', 'aB', 'Aba'):
+        assert loaded.suggest(prefix, limit=50) == index.suggest(prefix, limit=50)
+
+
+@pytest.fixture
+def conn(tmpdir):
+    db_file = str(tmpdir.join('clearfile.db'))
+    db.create_db_if_not_exists(SCHEMA, db_file)
+    conn = dataset.connect(f'sqlite:///{db_file}')
+    with conn:
+        db.add_notebook(conn, 'maths')
+        db.add_notebook(conn, 'physics')
+        for uuid in ('a', 'b', 'c'):
+            db.add_note(conn, note.Note(uuid, f'Note {uuid}', 'image/jpeg',
+                                        tags=[note.Tag(None, uuid, 'calculus')]))
+        conn['notes'].update({'uuid': 'a', 'notebook': 1}, ['uuid'])
+        conn['notes'].update({'uuid': 'b', 'notebook': 1}, ['uuid'])
+    db.load_indexes(conn)
+    return conn
+
+
+def update(conn, data):
+    with conn:
+        changes = db.update_note(conn, data)
+    db.update_indexes(changes)
+
+
+def assert_indexes_match(conn):
+    """Check the indexes against ones rebuilt from the database."""
+    tags, notebooks = contents(db.tag_index), contents(db.notebook_index)
+    db.load_indexes(conn)
+    assert contents(db.tag_index) == tags
+    assert contents(db.notebook_index) == notebooks
+
+
+def test_update_note_moves_between_notebooks(conn):
+    # Moving into an empty notebook, then out of it again, deletes the notebook.
+    update(conn, {'uuid': 'c', 'notebook': '2'})
+    assert db.notebook_index.suggest('') == [('maths', 2), ('physics', 1)]
+    assert_indexes_match(conn)
+    update(conn, {'uuid': 'c', 'notebook': '2'})
+    assert_indexes_match(conn)
+    update(conn, {'uuid': 'c', 'notebook': '1'})
+    assert db.notebook_index.suggest('') == [('maths', 3)]
+    assert conn['notebooks'].find_one(name='physics') is None
+    assert_indexes_match(conn)
+
+    # Moving out of a notebook with other notes keeps it.
+    update(conn, {'uuid': 'a', 'notebook': None})
+    assert db.notebook_index.suggest('') == [('maths', 2)]
+    assert_indexes_match(conn)
+    update(conn, {'uuid': 'a', 'tags': ['algebra']})
+    assert db.tag_index.suggest('') == [('calculus', 2), ('algebra', 1)]
+    assert_indexes_match(conn)
+
+
+def test_update_note_rolled_back(conn):
+    before = contents(db.tag_index), contents(db.notebook_index)
+    with pytest.raises(RuntimeError):
+        with conn:
+            changes = db.update_note(conn, {'uuid': 'a', 'notebook': '2', 'tags': []})
+            raise RuntimeError('transaction fails before commit')
+    assert changes
+    assert (contents(db.tag_index), contents(db.notebook_index)) == before
+    assert_indexes_match(conn)